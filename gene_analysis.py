@@ -5,19 +5,81 @@
 
 import pandas as pd
 import numpy as np
-from scipy.stats import spearmanr
-from statsmodels.stats.multitest import multipletests
+import numba
+import pyarrow as pa
+import pyarrow.parquet as pq
+from joblib import Parallel, delayed
+from scipy.stats import false_discovery_control, rankdata, t as t_dist
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-import seaborn as sns
 import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+# bottleneck's C rankdata is 2–3× faster than SciPy's; same average-tie ranks
+try:
+    from bottleneck import rankdata as rank_rows
+except ImportError:
+    rank_rows = rankdata
 
 # ------------------------------------------------------------
 # Step 1 — Load Core Files
 # ------------------------------------------------------------
+def cache_matches(path_pq, usecols=None, dtype=None):
+    """Whether a Parquet cache holds every requested column with the requested dtype."""
+    schema = pq.read_schema(path_pq)
+    types = {f.name: np.dtype(f.type.to_pandas_dtype()) for f in schema}
+    index_cols = [c for c in (schema.pandas_metadata or {}).get("index_columns", []) if isinstance(c, str)]
+    wanted = usecols if usecols is not None else [c for c in types if c not in index_cols]
+    if not set(wanted) <= set(types):
+        return False
+    if dtype is None:
+        return True
+    expected = dtype if isinstance(dtype, dict) else dict.fromkeys(wanted, dtype)
+    return all(types[c] == np.dtype(t) for c, t in expected.items())
+
+def load_cached(path_csv, usecols=None, dtype=None, **read_kwargs):
+    """Read a large DepMap CSV, caching it as Parquet beside the source.
+
+    Later runs load the columnar copy instead of re-parsing the text. The cache
+    is rebuilt if the CSV is newer, if it lacks a requested column (``usecols``)
+    or if a column's dtype differs from ``dtype``, which is applied once before
+    caching. Caching is best-effort: the file is written atomically, and an
+    unwritable or unreadable cache only costs the speed-up.
+    """
+    path_pq = os.path.splitext(path_csv)[0] + ".parquet"
+    if os.path.exists(path_pq) and os.path.getmtime(path_pq) >= os.path.getmtime(path_csv):
+        try:
+            if cache_matches(path_pq, usecols, dtype):
+                return pd.read_parquet(path_pq, engine="pyarrow", columns=usecols)
+        except (OSError, pa.ArrowException) as e:
+            print(f"⚠️ Ignoring unreadable cache {path_pq} ({e}); re-reading the CSV.")
+    df = pd.read_csv(path_csv, usecols=usecols, **read_kwargs)
+    if dtype is not None:
+        df = df.astype(dtype)
+    path_tmp = path_pq + ".tmp"
+    try:
+        df.to_parquet(path_tmp, engine="pyarrow", compression="snappy")
+        os.replace(path_tmp, path_pq)
+    except OSError as e:
+        print(f"⚠️ Could not cache {path_csv} as Parquet ({e}); continuing without cache.")
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+    return df
+
 print("Loading data...")
 model = pd.read_csv("Model.csv")
-crispr = pd.read_csv("CRISPRGeneEffect.csv", index_col=0)
-omics_expr = pd.read_csv("OmicsExpressionTPMLogp1HumanProteinCodingGenes.csv")
+crispr = load_cached("CRISPRGeneEffect.csv", dtype=np.float32, index_col=0)
+
+# Only the immune proxy genes of the expression matrix are ever used: sniff
+# the header and parse just ModelID plus those columns
+OMICS_CSV = "OmicsExpressionTPMLogp1HumanProteinCodingGenes.csv"
+immune_markers = ["CD274","CXCL9","CXCL10","STAT1","IRF1","HLA-A","HLA-B","B2M","TAP1","TGFB1"]
+omics_header = pd.read_csv(OMICS_CSV, nrows=0).columns
+immune_genes = [col for col in omics_header if col != "ModelID" and any(marker in col for marker in immune_markers)]
+omics_expr = load_cached(OMICS_CSV, usecols=["ModelID"] + immune_genes,
+                         dtype={g: np.float64 for g in immune_genes})
 print("Files loaded successfully!")
 
 # Fix orientation (rows = genes, columns = models)
@@ -34,84 +96,222 @@ print(f"OMICS shape after cleaning: {omics_expr.shape}")
 # ------------------------------------------------------------
 # Step 2 — Define Immune Proxy Genes
 # ------------------------------------------------------------
-immune_markers = ["CD274","CXCL9","CXCL10","STAT1","IRF1","HLA-A","HLA-B","B2M","TAP1","TGFB1"]
-immune_genes = [col for col in omics_expr.columns if any(marker in col for marker in immune_markers)]
 print(f"Matched {len(immune_genes)} immune genes from omics expression.")
 
+# Contiguous float32 matrices with model → column/row maps, so each cancer
+# slices plain ndarrays instead of materializing new DataFrames
+genes = crispr.index
+crispr_arr = np.ascontiguousarray(crispr.values, dtype=np.float32)   # genes × models
+crispr_model_to_i = {m: i for i, m in enumerate(crispr.columns)}
+immune_arr = np.ascontiguousarray(omics_expr.values, dtype=np.float64)   # models × immune genes
+omics_model_to_i = {m: i for i, m in enumerate(omics_expr.index)}
+
+# The proxy of a model doesn't depend on the cancer: reduce it once for all
+# models and let each cancer index into it. It stays float64 — float32
+# rounding would create or break ties between models and shift their ranks.
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", RuntimeWarning)   # all-NaN rows → NaN, as pandas mean
+    immune_proxy_all = np.nanmean(immune_arr, axis=1, dtype=np.float64)
+
 # Output directory
 os.makedirs("Cancer_Specific_Results", exist_ok=True)
 
 # ------------------------------------------------------------
-# Step 3 — Loop Through Each Cancer Type
+# Vectorized Spearman helpers
 # ------------------------------------------------------------
+def spearman_pvalues(rho, n):
+    """Two-sided p-values for Spearman ρ from the t-distribution (as scipy.stats.spearmanr)."""
+    dof = n - 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = rho * np.sqrt(dof / ((1.0 + rho) * (1.0 - rho)))
+    return 2 * t_dist.sf(np.abs(t), dof)
+
+@numba.njit(cache=True)
+def _rank_average(a):
+    """1-based ranks of a 1-D array, ties averaged (rankdata's default)."""
+    order = np.argsort(a, kind="mergesort")
+    ranks = np.empty(a.size)
+    i = 0
+    while i < a.size:
+        j = i
+        while j + 1 < a.size and a[order[j + 1]] == a[order[i]]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[order[k]] = 0.5 * (i + j) + 1.0
+        i = j + 1
+    return ranks
+
+@numba.njit(cache=True, parallel=True)
+def spearman_rows_with_nan(X, y):
+    """Pairwise-complete Spearman ρ of each row of X vs y (NaN below 5 valid pairs)."""
+    rho = np.full(X.shape[0], np.nan)
+    for i in numba.prange(X.shape[0]):
+        mask = ~np.isnan(X[i])
+        if np.count_nonzero(mask) < 5:
+            continue
+        xr = _rank_average(X[i][mask])
+        yr = _rank_average(y[mask])
+        xr -= xr.mean()
+        yr -= yr.mean()
+        den = np.sqrt((xr * xr).sum() * (yr * yr).sum())
+        if den > 0:   # constant x or y → ρ stays NaN, like spearmanr
+            rho[i] = (xr * yr).sum() / den
+    return rho
+
+def spearman_rows(X, y):
+    """Spearman ρ, p-value and valid-pair count of every row of X (genes × models) vs y.
+
+    Complete rows are ranked once and correlated with the ranked proxy in a
+    single matrix product; only the (few) rows containing NaN fall back to
+    the compiled pairwise-complete kernel.
+    """
+    keep = ~np.isnan(y)
+    X, y = X[:, keep], y[keep]
+    observed = ~np.isnan(X)
+    n_valid = observed.sum(axis=1)
+    nan_rows = n_valid < y.size
+    rho = np.full(X.shape[0], np.nan)
+
+    Xr = rank_rows(X[~nan_rows], axis=1).astype(np.float32)   # one call for the whole block
+    Xr -= Xr.mean(axis=1, keepdims=True)
+    yr = rankdata(y).astype(np.float32)
+    yr -= yr.mean()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rho[~nan_rows] = (Xr @ yr) / np.sqrt((Xr ** 2).sum(axis=1) * (yr ** 2).sum())
+
+    if nan_rows.any():
+        rho[nan_rows] = spearman_rows_with_nan(X[nan_rows], y)
+
+    rho = np.clip(rho, -1.0, 1.0)   # float32 round-off can exceed |1|
+    return rho, spearman_pvalues(rho, n_valid), n_valid
+
+# ------------------------------------------------------------
+# Step 3 — Analyze Each Cancer Type (in parallel)
+# ------------------------------------------------------------
+def analyze_cancer(cancer, ci, oi, crispr_arr, immune_proxy_all, genes):
+    """Correlate every CRISPR gene with the immune proxy for one cancer.
+
+    Returns the results frame sorted by FDR, or None when no gene has enough
+    valid models.
+    """
+    print(f"\n🎯 Analyzing {cancer} cancer...")
+
+    X = crispr_arr[:, ci]
+    immune_proxy = immune_proxy_all[oi]
+
+    rho, p, n_valid = spearman_rows(X, immune_proxy)
+    keep = n_valid >= 5
+    if not keep.any():
+        print(f"⚠️ No valid results for {cancer}")
+        return None
+
+    results_df = pd.DataFrame({"Gene": genes[keep], "Spearman_r": rho[keep], "P": p[keep]})
+    # BH over finite p-values only; constant genes (ρ = NaN) keep FDR = NaN
+    pvals = results_df["P"].to_numpy()
+    fdr = np.full(len(pvals), np.nan)
+    ok = np.isfinite(pvals)
+    fdr[ok] = false_discovery_control(pvals[ok], method="bh")
+    results_df["FDR"] = fdr
+    results_df["-log10P"] = -np.log10(results_df["P"])
+    return results_df.sort_values("FDR")
+
+def save_results(cancer, results_df):
+    """Write one cancer's results CSV."""
+    out_file = f"Cancer_Specific_Results/CRISPR_TME_{cancer.replace('/', '_')}_Results.csv"
+    results_df.to_csv(out_file, index=False)
+    print(f"✅ Saved {len(results_df)} results for {cancer}")
+
 unique_cancers = sorted(model["OncotreePrimaryDisease"].dropna().unique())
 print(f"\nFound {len(unique_cancers)} unique cancer types.")
 print(unique_cancers[:10], "...")  # preview first 10
 
-summary_rows = []
+# Hoist the model lookups out of the loop: models shared by CRISPR and OMICS,
+# and each cancer's models grouped in a single pass over a disease column
+# lower-cased once (groupby drops the NaN diseases)
+common_all = set(crispr.columns) & set(omics_expr.index)
+model["_disease_lc"] = model["OncotreePrimaryDisease"].str.lower()
+cancer_to_models = {k: v.unique().tolist() for k, v in model.groupby("_disease_lc")["ModelID"]}
 
+# Build one task per cancer with enough models; skipped cancers never reach a worker
+tasks = []
 for cancer in unique_cancers:
-    print(f"\n🎯 Analyzing {cancer} cancer...")
-
     # Identify models for this cancer
-    cancer_models = model[model["OncotreePrimaryDisease"].str.lower() == cancer.lower()]["ModelID"].unique().tolist()
-    common_models = sorted(list(set(crispr.columns).intersection(set(omics_expr.index)).intersection(set(cancer_models))))
+    common_models = sorted(common_all.intersection(cancer_to_models[cancer.lower()]))
 
     if len(common_models) < 25:
         print(f"⚠️ Skipping {cancer}: only {len(common_models)} models.")
         continue
 
-    crispr_sub = crispr[common_models]
-    omics_sub = omics_expr.loc[common_models]
+    ci = np.fromiter((crispr_model_to_i[m] for m in common_models), dtype=np.int64, count=len(common_models))
+    oi = np.fromiter((omics_model_to_i[m] for m in common_models), dtype=np.int64, count=len(common_models))
+    tasks.append((cancer, ci, oi))
 
-    immune_proxy = omics_sub[immune_genes].mean(axis=1)
+# Blocking writes (CSV, PNG encoding) go to a thread pool so the parent keeps
+# consuming results; PNG encoding and file I/O release the GIL
+io_pool = ThreadPoolExecutor(max_workers=4)
+io_futures = []
 
-    results = []
-    for gene in crispr_sub.index:
-        x = crispr_sub.loc[gene].astype(float).values
-        y = immune_proxy.astype(float).values
-        mask = ~np.isnan(x) & ~np.isnan(y)
-        if mask.sum() < 5:
-            continue
-        rho, p = spearmanr(x[mask], y[mask])
-        results.append([gene, rho, p])
+# One volcano Figure for every cancer: the reference lines, labels and legend
+# persist, and only the marker data and title change between saves
+fig, ax = plt.subplots(figsize=(7,5), dpi=150)
+bg_line, = ax.plot([], [], '.', ms=1.5, color='lightgrey', rasterized=True)
+sig_line, = ax.plot([], [], '.', ms=2, color='tab:blue', alpha=0.7, rasterized=True)
+ax.axvline(0, color='grey', linestyle='--', linewidth=0.8)
+ax.axhline(-np.log10(0.05), color='red', linestyle='--', linewidth=0.8, label="p=0.05")
+ax.set_xlabel("Spearman Correlation (ρ)")
+ax.set_ylabel("-log10(P-value)")
+ax.legend()
 
-    if not results:
-        print(f"⚠️ No valid results for {cancer}")
-        continue
+def save_volcano(cancer, results_df):
+    """Redraw the shared volcano Figure for one cancer and queue its PNG.
 
-    results_df = pd.DataFrame(results, columns=["Gene", "Spearman_r", "P"])
-    results_df["FDR"] = multipletests(results_df["P"], method="fdr_bh")[1]
-    results_df["-log10P"] = -np.log10(results_df["P"])
-    results_df = results_df.sort_values("FDR")
+    Plots the 1000 most significant genes over a random 1000-gene background.
+    The Figure is rendered here and only a copy of its pixels is handed to the
+    I/O pool, so the next cancer can redraw it while the PNG is written.
+    """
+    sig = results_df.nlargest(1000, "-log10P")
+    bg = results_df.sample(min(1000, len(results_df)), random_state=0)
+    bg_line.set_data(bg["Spearman_r"], bg["-log10P"])
+    sig_line.set_data(sig["Spearman_r"], sig["-log10P"])
+    ax.relim()
+    ax.autoscale_view()
+    ax.set_title(f"{cancer} Cancer — CRISPR vs Immune Proxy")
+    fig.tight_layout()
+    fig.canvas.draw()
+    pixels = np.asarray(fig.canvas.buffer_rgba()).copy()
+    png_path = f"Cancer_Specific_Results/Volcano_{cancer.replace('/', '_')}.png"
+    io_futures.append(io_pool.submit(plt.imsave, png_path, pixels, dpi=fig.dpi))
 
-    # Save results
-    out_file = f"Cancer_Specific_Results/CRISPR_TME_{cancer.replace('/', '_')}_Results.csv"
-    results_df.to_csv(out_file, index=False)
-    print(f"✅ Saved {len(results_df)} results for {cancer}")
+# Cancers are independent: fan them out across cores. loky memory-maps the
+# large CRISPR array read-only instead of copying it per worker, and
+# results stream back in order so plotting overlaps the remaining compute.
+results_iter = Parallel(n_jobs=-1, backend="loky", return_as="generator")(
+    delayed(analyze_cancer)(cancer, ci, oi, crispr_arr, immune_proxy_all, genes)
+    for cancer, ci, oi in tasks
+)
 
-    # Volcano plot
-    plt.figure(figsize=(7,5))
-    sns.scatterplot(data=results_df, x="Spearman_r", y="-log10P", s=10, alpha=0.7)
-    plt.axvline(0, color='grey', linestyle='--', linewidth=0.8)
-    plt.axhline(-np.log10(0.05), color='red', linestyle='--', linewidth=0.8, label="p=0.05")
-    plt.title(f"{cancer} Cancer — CRISPR vs Immune Proxy")
-    plt.xlabel("Spearman Correlation (ρ)")
-    plt.ylabel("-log10(P-value)")
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(f"Cancer_Specific_Results/Volcano_{cancer.replace('/', '_')}.png", dpi=300)
-    plt.close()
+summary_rows = []
+for (cancer, ci, oi), results_df in zip(tasks, results_iter):
+    if results_df is None:
+        continue
+
+    io_futures.append(io_pool.submit(save_results, cancer, results_df))
+    save_volcano(cancer, results_df)
 
     # Summary
     top_pos = results_df.sort_values("Spearman_r", ascending=False).head(3)
     top_neg = results_df.sort_values("Spearman_r").head(3)
     summary_rows.append({
         "Cancer": cancer,
-        "N_Models": len(common_models),
+        "N_Models": len(ci),
         "Top_Positive": "; ".join(top_pos["Gene"].tolist()),
         "Top_Negative": "; ".join(top_neg["Gene"].tolist())
     })
+plt.close(fig)
+
+for future in io_futures:
+    future.result()   # surface any write error
+io_pool.shutdown(wait=True)
 
 # ------------------------------------------------------------
 # Step 4 — Summary Table of All Cancers
@@ -3,8 +3,10 @@
 # Author: Guna Kulothungan | 2025
 # ============================================================
 
-import os, glob, pandas as pd, numpy as np
+import os, glob, time, pandas as pd, numpy as np
+import pyarrow as pa, pyarrow.compute as pc
 import matplotlib.pyplot as plt
+from matplotlib.font_manager import FontProperties
 import seaborn as sns
 sns.set(context="talk", style="whitegrid")
 
@@ -31,7 +33,7 @@ cancer_top_pos, cancer_top_neg, cancer_list = {}, {}, []
 
 for f in files:
     df = pd.read_csv(f)
-    df["Gene_clean"] = df["Gene"].astype(str).apply(lambda s: s.split(" (")[0].strip())
+    df["Gene_clean"] = df["Gene"].astype(str).str.split(" (", n=1, regex=False).str[0].str.strip()
     cancer = os.path.basename(f).replace("CRISPR_TME_", "").replace("_Results.csv", "")
     cancer_list.append(cancer)
     pos = df.sort_values("Spearman_r", ascending=False).head(TOP_N)["Gene_clean"].tolist()
@@ -56,17 +58,46 @@ except ImportError:
 
 gp = GProfiler(return_dataframe=True)
 
+# One multi-query request for every (cancer, direction) gene list; g:Profiler
+# returns a single frame whose "query" column names the originating list
+queries, query_labels = {}, {}
 for cancer in cancer_list:
     for label, gene_list in {"Positive": cancer_top_pos[cancer],
                              "Negative": cancer_top_neg[cancer]}.items():
         if not gene_list:
             continue
+        name = f"{label}_{cancer}"
+        queries[name] = gene_list
+        query_labels[name] = (cancer, label)
+
+def profile_with_retry(query, retries=4, backoff=2.0):
+    """Call g:Profiler, retrying transient failures with exponential backoff."""
+    for attempt in range(retries):
         try:
-            enrich = gp.profile(
+            return gp.profile(
                 organism="hsapiens",
-                query=gene_list,
+                query=query,
                 sources=["GO:BP", "KEGG"]
             )
+        except Exception as e:
+            if attempt == retries - 1:
+                raise
+            wait = backoff * 2 ** attempt
+            print(f"⚠️ g:Profiler request failed ({e}); retrying in {wait:.0f}s...")
+            time.sleep(wait)
+
+enrich_all = None
+if queries:
+    try:
+        enrich_all = profile_with_retry(queries)
+    except Exception as e:
+        print("⚠️ Enrichment failed:", e)
+
+if enrich_all is not None:
+    by_query = dict(tuple(enrich_all.groupby("query", sort=False))) if not enrich_all.empty else {}
+    for name, (cancer, label) in query_labels.items():
+        enrich = by_query.get(name, enrich_all.iloc[:0])
+        try:
             out_csv = os.path.join(OUT_DIR, f"Enrichment_{label}_{cancer}.csv")
             enrich.to_csv(out_csv, index=False)
             # Plot top 10 terms
@@ -87,37 +118,73 @@ for cancer in cancer_list:
 # ------------------------------------------------------------
 print("\nCalculating Jaccard similarity between cancers...")
 
-def jaccard(a, b):
-    A, B = set(a), set(b)
-    if not A and not B:
-        return 0.0
-    return len(A & B) / len(A | B)
-
+# Presence matrix B (cancers × gene universe). Gene strings live in Arrow
+# arrays so uniqueness, membership and counting run in C rather than through
+# Python sets / dicts
+all_pos = pa.array([g for c in cancer_list for g in cancer_top_pos[c]], type=pa.large_string())
+uniq = pc.unique(all_pos)
+universe = uniq.take(pc.array_sort_indices(uniq))
 n = len(cancer_list)
-jmat = np.zeros((n, n))
-for i, a in enumerate(cancer_list):
-    for j, b in enumerate(cancer_list):
-        jmat[i, j] = jaccard(cancer_top_pos[a], cancer_top_pos[b])
+B = np.zeros((n, len(universe)), dtype=np.uint8)
+for i, c in enumerate(cancer_list):
+    top = pa.array(cancer_top_pos[c], type=pa.large_string())
+    B[i] = pc.is_in(universe, value_set=top).to_numpy(zero_copy_only=False)
+
+# Pack each row of B into uint64 bitsets so all pairwise intersections come
+# from AND + popcount instead of set building: |A ∩ B| is popcount(A & B)
+# summed over words
+words = (len(universe) + 63) // 64
+packed = np.zeros((n, words * 8), dtype=np.uint8)
+packed[:, :(len(universe) + 7) // 8] = np.packbits(B, axis=1)
+bits = packed.view(np.uint64)
+both = bits[:, None, :] & bits[None, :, :]
+if hasattr(np, "bitwise_count"):   # NumPy >= 2.0
+    overlap = np.bitwise_count(both).sum(axis=-1, dtype=np.int64)
+else:
+    overlap = np.unpackbits(both.view(np.uint8), axis=-1).sum(axis=-1, dtype=np.int64)
+rs = np.diag(overlap)   # set sizes
+union = rs[:, None] + rs[None, :] - overlap
+jmat = np.divide(overlap, union, out=np.zeros((n, n)), where=union > 0)
 
 jdf = pd.DataFrame(jmat, index=cancer_list, columns=cancer_list)
 jdf.to_csv(os.path.join(OUT_DIR, "Jaccard_Positive_Matrix.csv"))
 
-plt.figure(figsize=(10, 8))
-sns.heatmap(jdf, cmap="viridis", linewidths=0.3)
-plt.title(f"Jaccard Similarity (Top {TOP_N} Positive Genes)")
-plt.tight_layout()
-plt.savefig(os.path.join(OUT_DIR, "Jaccard_Positive_Heatmap.png"), dpi=300)
-plt.close()
+def heatmap(df, ax, cmap, cbar_label=None):
+    """Draw df as a single QuadMesh (row 0 on top, labelled cell centres).
+
+    Like seaborn's "auto" tick labels, only every k-th label is shown when
+    the full set would overlap at the current tick font size.
+    """
+    im = ax.pcolormesh(df.values, cmap=cmap)
+    ax.figure.colorbar(im, ax=ax, label=cbar_label)
+    ax.invert_yaxis()
+    ax.grid(False)
+
+    bbox = ax.get_window_extent().transformed(ax.figure.dpi_scale_trans.inverted())
+    for axis, labels, length_in, key in ((ax.xaxis, df.columns, bbox.width, "xtick.labelsize"),
+                                         (ax.yaxis, df.index, bbox.height, "ytick.labelsize")):
+        fontsize = FontProperties(size=plt.rcParams[key]).get_size_in_points()
+        step = max(int(np.ceil(len(labels) * fontsize / (length_in * 72))), 1)
+        ticks = np.arange(0, len(labels), step)
+        axis.set_ticks(ticks + 0.5)
+        axis.set_ticklabels(labels[ticks])
+    ax.tick_params(axis="x", labelrotation=90)
+
+fig, ax = plt.subplots(figsize=(10, 8))
+heatmap(jdf, ax, cmap="viridis")
+ax.set_title(f"Jaccard Similarity (Top {TOP_N} Positive Genes)")
+fig.tight_layout()
+fig.savefig(os.path.join(OUT_DIR, "Jaccard_Positive_Heatmap.png"), dpi=300)
+plt.close(fig)
 
 # ------------------------------------------------------------
 # Step 5 — Gene frequency and presence/absence heatmap
 # ------------------------------------------------------------
-from collections import Counter
-pos_counter = Counter()
-for c in cancer_list:
-    pos_counter.update(cancer_top_pos[c])
-
-pos_df = pd.DataFrame(pos_counter.items(), columns=["Gene", "Count"]).sort_values("Count", ascending=False)
+freq = pc.value_counts(all_pos)
+pos_df = pd.DataFrame({
+    "Gene": freq.field("values").to_pandas(),
+    "Count": freq.field("counts").to_pandas()
+}).sort_values("Count", ascending=False)
 pos_df.to_csv(os.path.join(OUT_DIR, "Global_Top_Positive_Genes.csv"), index=False)
 
 # Plot top 20 most recurrent positive genes
@@ -131,28 +198,20 @@ plt.close()
 # Presence/absence matrix
 M = 60
 top_genes = pos_df["Gene"].head(M).tolist()
-mat = pd.DataFrame(0, index=top_genes, columns=cancer_list)
-for c in cancer_list:
-    for g in cancer_top_pos[c]:
-        if g in mat.index:
-            mat.loc[g, c] = 1
+cols = pc.index_in(pa.array(top_genes, type=pa.large_string()), value_set=universe).to_numpy()
+mat = pd.DataFrame(B[:, cols].T.astype(int), index=top_genes, columns=cancer_list)
 mat.to_csv(os.path.join(OUT_DIR, "Presence_Absence_Positive.csv"))
 
-plt.figure(figsize=(12, 8))
-sns.heatmap(mat, cmap="Blues", cbar_kws={"label": "Presence (1=Top Gene)"}, linewidths=0.3)
-plt.title(f"Presence of Frequent Positive Genes Across Cancers (Top {M})")
-plt.tight_layout()
-plt.savefig(os.path.join(OUT_DIR, "Presence_Positive_Heatmap.png"), dpi=300)
-plt.close()
+fig, ax = plt.subplots(figsize=(12, 8))
+heatmap(mat, ax, cmap="Blues", cbar_label="Presence (1=Top Gene)")
+ax.set_title(f"Presence of Frequent Positive Genes Across Cancers (Top {M})")
+fig.tight_layout()
+fig.savefig(os.path.join(OUT_DIR, "Presence_Positive_Heatmap.png"), dpi=300)
+plt.close(fig)
 
 # ------------------------------------------------------------
 # Step 6 — Overlap count matrix (shared positive genes)
 # ------------------------------------------------------------
-overlap = np.zeros((n, n), dtype=int)
-for i, a in enumerate(cancer_list):
-    for j, b in enumerate(cancer_list):
-        overlap[i, j] = len(set(cancer_top_pos[a]) & set(cancer_top_pos[b]))
-
 overlap_df = pd.DataFrame(overlap, index=cancer_list, columns=cancer_list)
 overlap_df.to_csv(os.path.join(OUT_DIR, "Overlap_Count_Positive.csv"))
 